@@ -0,0 +1,388 @@
+"""Chat state and message handling, independent of the network I/O.
+
+This module is the per-message hot path of the server. It is fully type
+annotated so it can be compiled to a C extension with `mypyc chat_core.py`;
+the resulting chat_core.*.so is picked up instead of this file on import.
+server.py keeps the asyncio bootstrap and socket handling in pure Python.
+"""
+import asyncio
+import logging
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from protocol import MAX_MESSAGE_SIZE, frame_message, frame_server_message
+
+Message = Dict[str, Any]
+Frame = Tuple[bytes, ...]
+
+# Notifications with no variable part are framed once at import time
+INVALID_FORMAT_FRAME: Frame = frame_server_message("Invalid message format.")
+
+# Nicknames and channel names are echoed in messages to other clients, so
+# they are kept short. That way the server only ever adds a little to what
+# a client sent, and its frames stay within what the clients accept.
+MAX_NAME_LENGTH = 64
+
+# A client that falls this far behind is disconnected instead of buffering
+# every broadcast for it forever. Several maximum size messages fit, so a
+# short burst doesn't drop a client that is merely slower than the sender.
+# Broadcast frames are shared by all recipients, so this isn't the memory
+# used per connection.
+MAX_QUEUED_BYTES = 16 * MAX_MESSAGE_SIZE
+
+# Per-message events are logged at DEBUG level. Arguments are passed separately
+# so the log line is only formatted when that level is actually enabled.
+logger = logging.getLogger("chat")
+
+def is_valid_name(name: Any) -> bool:
+    """Return whether a nickname or channel name is a short enough string."""
+    return isinstance(name, str) and len(name) <= MAX_NAME_LENGTH
+
+class Connection:
+    def __init__(self, address: Any) -> None:
+        """Hold the address and outgoing queue of a single client connection."""
+        self.address = address
+        # Frames waiting to be written, None ends the writer
+        self.send_queue: "asyncio.Queue[Optional[Frame]]" = asyncio.Queue()
+        self.queued_bytes = 0 # Size of the frames in send_queue
+        # Closes the connection at once, set by the network side
+        self.abort: Optional[Callable[[], None]] = None
+        self.dropped = False # Aborted for falling behind, nothing more is queued
+
+class ChatCore:
+    def __init__(self) -> None:
+        """Initialize the chat state."""
+        self.clients: Dict[Connection, Dict[str, str]] = {} # {connection: {"nickname": nickname, "channel": channel}}
+        # {nickname: {connection: None}}, reverse index of self.clients. Several
+        # clients may share a nickname, they are kept in the order they joined.
+        self.nicknames: Dict[str, Dict[Connection, None]] = {}
+        # {channel: {connection: None}}, dicts keep members in join order
+        self.channels: Dict[str, Dict[Connection, None]] = {"general": {}} # Default channel
+        # {message type: handler}, used by process_message
+        self.message_handlers: Dict[str, Callable[[Connection, Message], None]] = {
+            "disconnect": self.handle_disconnect,
+            "chat": self.handle_chat,
+            "private": self.handle_private,
+            "join_channel": self.handle_join_channel,
+            "list_channels": self.handle_list_channels,
+            "list_users": self.handle_list_users,
+        }
+        # Publishes a message to the other worker processes, None when the
+        # server runs as a single process
+        self.relay: Optional[Callable[[Message], None]] = None
+
+    def handle_message(self, connection: Connection, message: Optional[Message]) -> None:
+        """Handle a decoded message, or None for one that failed to decode."""
+        if message is None:
+            self.send_frame_to_client(connection, INVALID_FORMAT_FRAME)
+            logger.warning("Invalid message format from %s", connection.address)
+        elif connection in self.clients:
+            self.process_message(connection, message)
+        else:
+            # The first message from a client carries its nickname
+            self.register_client(connection, message)
+
+    def register_client(self, connection: Connection, nickname_message: Message) -> None:
+        """Register a client after it has sent its nickname."""
+        client_address = connection.address
+        nickname = nickname_message.get("nickname", f"User-{client_address[0]}")
+        if not is_valid_name(nickname):
+            self.send_server_message(
+                connection, f"Invalid nickname, use at most {MAX_NAME_LENGTH} characters."
+            )
+            logger.warning("Invalid nickname from %s", client_address)
+            raise ConnectionError("Invalid nickname")
+
+        # Register the client
+        self.clients[connection] = {
+            "nickname": nickname,
+            "channel": "general"
+        }
+        self.nicknames.setdefault(nickname, {})[connection] = None
+        self.channels["general"][connection] = None
+
+        # Send welcome message
+        self.send_server_message(connection, f"Welcome to the chat, {nickname}!")
+        logger.info("Client %s connected from %s", nickname, client_address)
+
+        # Notify others
+        self.broadcast_frame(
+            frame_server_message(f"{nickname} has joined the channel."),
+            exclude=connection, channel="general"
+        )
+        logger.debug("Broadcasted join message to channel general")
+
+    def process_message(self, connection: Connection, message: Message) -> None:
+        """Process a message from a client."""
+        # One dict lookup instead of comparing the type against every branch
+        handler = self.message_handlers.get(message.get("type", ""))
+        if handler is None:
+            self.handle_unknown(connection, message)
+        else:
+            handler(connection, message)
+
+    def handle_disconnect(self, connection: Connection, message: Message) -> None:
+        """Handle a client explicitly disconnecting."""
+        logger.info("Client %s sent disconnect message", self.clients[connection]["nickname"])
+        raise ConnectionError("Client requested disconnect")
+
+    def handle_chat(self, connection: Connection, message: Message) -> None:
+        """Broadcast a chat message to the sender's channel."""
+        client_info = self.clients[connection]
+        self.broadcast_message({
+            "type": "chat",
+            "sender": client_info["nickname"],
+            "content": message.get("content", "")
+        }, channel=client_info["channel"])
+
+    def handle_private(self, connection: Connection, message: Message) -> None:
+        """Forward a private message to its recipient."""
+        recipient = message.get("recipient", "")
+        content = message.get("content", "")
+        self.send_private_message(connection, recipient, content)
+
+    def handle_join_channel(self, connection: Connection, message: Message) -> None:
+        """Move the client to the requested channel."""
+        channel = message.get("channel", "")
+        if not is_valid_name(channel):
+            self.send_server_message(
+                connection, f"Invalid channel name, use at most {MAX_NAME_LENGTH} characters."
+            )
+            logger.warning("Invalid channel name from %s", self.clients[connection]["nickname"])
+            return
+        self.join_channel(connection, channel)
+
+    def handle_list_channels(self, connection: Connection, message: Message) -> None:
+        """Send the channel list to the client."""
+        self.list_channels(connection)
+
+    def handle_list_users(self, connection: Connection, message: Message) -> None:
+        """Send the users of the requested channel to the client."""
+        channel = message.get("channel", self.clients[connection]["channel"])
+        self.list_users(connection, channel)
+
+    def handle_unknown(self, connection: Connection, message: Message) -> None:
+        """Reply to a message with an unknown type."""
+        self.send_message_to_client(connection, {
+            "type": "error",
+            "content": "Unknown message type."
+        })
+        logger.warning("Unknown message type from %s: %s",
+                       self.clients[connection]["nickname"], message.get("type", ""))
+
+    def handle_relay_message(self, message: Message) -> None:
+        """Deliver a message published by another worker process to local clients."""
+        frame: Frame = (message.get("frame", b""),)
+        if message.get("type") == "private":
+            recipient_connection = self.find_client(message.get("recipient", ""))
+            if recipient_connection is not None:
+                self.send_frame_to_client(recipient_connection, frame)
+        else:
+            # Channels are per worker, so skip ones no local client has joined
+            channel = message.get("channel")
+            if channel is None or channel in self.channels:
+                self.deliver_frame(frame, channel=channel)
+
+    def send_message_to_client(self, connection: Connection, message: Message) -> None:
+        """Send a message to a specific client."""
+        self.send_frame_to_client(connection, frame_message(message))
+
+    def send_server_message(self, connection: Connection, content: str) -> None:
+        """Send a server notification to a specific client."""
+        self.send_frame_to_client(connection, frame_server_message(content))
+
+    def send_frame_to_client(self, connection: Connection, frame: Frame) -> None:
+        """Send an already framed message to a specific client."""
+        if connection.dropped:
+            return
+
+        size = sum([len(buffer) for buffer in frame])
+        if connection.queued_bytes + size > MAX_QUEUED_BYTES and connection.abort is not None:
+            logger.warning("Client %s fell too far behind, dropping its connection",
+                           connection.address)
+            connection.dropped = True
+            connection.abort()
+            return
+
+        # The connection's writer task batches and writes queued frames
+        connection.queued_bytes += size
+        connection.send_queue.put_nowait(frame)
+
+    def broadcast_message(self, message: Message, exclude: Optional[Connection] = None,
+                          channel: Optional[str] = None) -> None:
+        """Broadcast a message to all clients in a channel."""
+        # Every recipient gets the same bytes, so encode the message only once
+        self.broadcast_frame(frame_message(message), exclude, channel)
+
+    def broadcast_frame(self, frame: Frame, exclude: Optional[Connection] = None,
+                        channel: Optional[str] = None) -> None:
+        """Broadcast an already framed message to all clients in a channel."""
+        self.deliver_frame(frame, exclude, channel)
+
+        # Members of the channel may be connected to other worker processes
+        if self.relay is not None:
+            self.relay({
+                "type": "broadcast",
+                "channel": channel,
+                "frame": b"".join(frame)
+            })
+
+    def deliver_frame(self, frame: Frame, exclude: Optional[Connection] = None,
+                      channel: Optional[str] = None) -> None:
+        """Send an already framed message to the local clients in a channel."""
+        members: Dict[Connection, Any]
+        if channel and channel in self.channels:
+            members = self.channels[channel]
+        else:
+            members = self.clients
+
+        # Snapshot the recipients once so the channel may change while sending
+        recipients: List[Connection] = [
+            connection for connection in members
+            if connection is not exclude and connection in self.clients
+        ]
+        logger.debug("Broadcasting to %d clients in channel %s", len(recipients), channel)
+
+        for connection in recipients:
+            try:
+                self.send_frame_to_client(connection, frame)
+            except Exception as e:
+                logger.warning("Error broadcasting to client: %s", e)
+
+    def find_client(self, nickname: str) -> Optional[Connection]:
+        """Return the connection of a nickname, or None if nobody uses it."""
+        # Like the old linear search, the client that joined first wins
+        holders = self.nicknames.get(nickname)
+        if not holders:
+            return None
+        return next(iter(holders))
+
+    def send_private_message(self, sender_connection: Connection, recipient_name: str,
+                             content: str) -> None:
+        """Send a private message to a specific user."""
+        sender_name = self.clients[sender_connection]["nickname"]
+        recipient_connection = self.find_client(recipient_name)
+
+        if recipient_connection:
+            # Send to recipient
+            self.send_message_to_client(recipient_connection, {
+                "type": "private",
+                "sender": sender_name,
+                "content": content
+            })
+            logger.debug("Private message sent from %s to %s", sender_name, recipient_name)
+
+        elif self.relay is not None:
+            # The recipient may be connected to another worker process, which
+            # delivers the message if it is. Nobody replies when it isn't.
+            self.relay({
+                "type": "private",
+                "recipient": recipient_name,
+                "frame": b"".join(frame_message({
+                    "type": "private",
+                    "sender": sender_name,
+                    "content": content
+                }))
+            })
+            logger.debug("Private message from %s to %s relayed to other workers",
+                         sender_name, recipient_name)
+
+        else:
+            self.send_server_message(sender_connection, f"User {recipient_name} not found.")
+            logger.debug("Private message failed: User %s not found", recipient_name)
+
+    def join_channel(self, connection: Connection, channel: str) -> None:
+        """Move a client to a different channel."""
+        client_info = self.clients[connection]
+        old_channel = client_info["channel"]
+
+        # Create the channel if it doesn't exist
+        if channel not in self.channels:
+            self.channels[channel] = {}
+            logger.info("Channel %s created", channel)
+
+        # Remove from old channel
+        if old_channel in self.channels:
+            self.channels[old_channel].pop(connection, None)
+
+        # Add to new channel
+        self.channels[channel][connection] = None
+        client_info["channel"] = channel
+
+        # Notify the client
+        self.send_server_message(connection, f"You have joined the channel: {channel}")
+        logger.info("%s joined channel %s", client_info['nickname'], channel)
+
+        # Notify others in the old channel
+        self.broadcast_frame(
+            frame_server_message(f"{client_info['nickname']} has joined the channel"),
+            exclude=connection, channel=channel
+        )
+        logger.debug("Broadcasted channel join message to %s", channel)
+
+    def list_channels(self, connection: Connection) -> None:
+        """Send a list of available channels to the client."""
+        channels = list(self.channels.keys())
+
+        self.send_message_to_client(connection, {
+            "type": "channel_list",
+            "channels": channels
+        })
+        logger.debug("Sent channel list to %s", self.clients[connection]['nickname'])
+
+    def list_users(self, connection: Connection, channel: str) -> None:
+        """Send a list of users in a channel to the client."""
+        user_list = [
+            self.clients[client]["nickname"]
+            for client in self.channels.get(channel, {})
+            if client in self.clients
+        ]
+
+        self.send_message_to_client(connection, {
+            "type": "user_list",
+            "channel": channel,
+            "users": user_list
+        })
+        logger.debug("Sent user list for channel %s to %s", channel, self.clients[connection]['nickname'])
+
+    def handle_client_disconnect(self, connection: Connection) -> None:
+        """Clean up when a client disconnects."""
+        nickname: Optional[str] = None
+        channel: Optional[str] = None
+
+        try:
+            if connection in self.clients:
+                # Get client info before removal
+                nickname = self.clients[connection]["nickname"]
+                channel = self.clients[connection]["channel"]
+
+                logger.info("Disconnecting client %s from channel %s", nickname, channel)
+
+                # Remove from all channels (in case client is in multiple)
+                for channel_name, clients in self.channels.items():
+                    if connection in clients:
+                        del clients[connection]
+                        logger.debug("Removed %s from channel %s", nickname, channel_name)
+
+                # Remove client from clients dict
+                del self.clients[connection]
+                holders = self.nicknames.get(nickname)
+                if holders is not None:
+                    holders.pop(connection, None)
+                    if not holders:
+                        del self.nicknames[nickname]
+                logger.debug("Removed %s from clients list", nickname)
+            else:
+                logger.debug("Client connection not found in clients dict during disconnect")
+        except Exception as e:
+            logger.error("Error in disconnect handler: %s", e)
+
+        # Let the writer task send what is still queued and close the connection
+        connection.send_queue.put_nowait(None)
+
+        # The client is already gone from every channel, so the notification
+        # goes to the remaining members only and can't reach the closed connection
+        if nickname is not None:
+            self.broadcast_frame(
+                frame_server_message(f"{nickname} has left the chat."),
+                channel=channel
+            )
@@ -1,8 +1,13 @@
 import socket
 import threading
-import json
 import time
 
+from protocol import (
+    frame_message, send_frame, MessageReader, DecodeError,
+    SetNickname, ChatMessage, PrivateMessage, JoinChannel, ListChannels,
+    ListUsers, Disconnect
+)
+
 class ChatClient:
     def __init__(self):
         """Initialize the chat client."""
@@ -22,13 +27,12 @@ class ChatClient:
 
         try:
             self.socket.connect((address, port))
+            # Send each message right away instead of waiting to coalesce them
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             self.connected = True
 
             # Send nickname to server
-            self.send_message({
-                "type": "set_nickname",
-                "nickname": nickname
-            })
+            self.send_message(SetNickname(nickname=nickname))
 
             # Start receiving messages in a separate thread
             self.received_thread = threading.Thread(target=self.receive_messages)
@@ -51,63 +55,51 @@ class ChatClient:
             return
         
         try:
-            self.socket.send(json.dumps(message).encode('utf-8'))
+            send_frame(self.socket, frame_message(message))
         except Exception as e:
             print(f"Failed to send message: {e}")
             self.disconnect()
 
     def send_chat_message(self, content):
         """Send a chat message to the current channel."""
-        self.send_message({
-            "type": "chat",
-            "content": content
-        })
+        self.send_message(ChatMessage(content=content))
 
     def send_private_message(self, recipient, content):
         """Send a private message to a specific user."""
-        self.send_message({
-            "type": "private",
-            "recipient": recipient,
-            "content": content
-        })
+        self.send_message(PrivateMessage(recipient=recipient, content=content))
 
     def join_channel(self, channel):
         """Join a different channel."""
-        self.send_message({
-            "type": "join_channel",
-            "channel": channel
-        })
+        self.send_message(JoinChannel(channel=channel))
         self.current_channel = channel
 
     def list_channels(self):
         """Request the list of avavilable channels."""
-        self.send_message({
-            "type": "list_channels"
-        })
+        self.send_message(ListChannels())
 
     def list_users(self, channel=None):
         """Request a list of users in a channel."""
         if not channel:
             channel = self.current_channel
 
-        self.send_message({
-            "type": "list_users",
-            "channel": channel
-        })
+        self.send_message(ListUsers(channel=channel))
 
     def receive_messages(self):
         """Receive and process messages from the server."""
+        reader = MessageReader(self.socket)
+
         try:
             while self.connected:
-                data = self.socket.recv(1024).decode('utf-8')
-                if not data:
-                    break
-
                 try:
-                    message = json.loads(data)
-                    self.process_message(message)
-                except json.JSONDecodeError:
+                    message = reader.read_message()
+                except DecodeError:
                     print("Received invalid message format")
+                    continue
+
+                if message is None:
+                    break
+
+                self.process_message(message)
 
         except ConnectionError:
             pass
@@ -117,38 +109,56 @@ class ChatClient:
 
     def process_message(self, message):
         """Process a received message."""
-        message_type = message.get("type", "")
-
-        if message_type == "chat":
-            sender = message.get("sender", "")
-            content = message.get("content", "")
-            print(f"[{self.current_channel}] {sender}: {content}")
-        
-        elif message_type == "private":
-            sender = message.get("sender", "Unknown")
-            content = message.get("content", "")
-            print(f"[Private from {sender}]: {content}")
-        
-        elif message_type == "server_message":
-            content = message.get("content", "")
-            print(f"[Server] {content}")
-
-        elif message_type == "channel_list":
-            channels = message.get("channels", [])
-            print("Available channels:")
-            for channel in channels:
-                print(f"- {channel}")
-
-        elif message_type == "user_list":
-            channel = message.get("channel", "")
-            users = message.get("users", [])
-            print(f"Users in channel {channel}:")
-            for user in users:
-                print(f"- {user}")
-        
-        elif message_type == "error":
-            error_message = message.get("content", "Unknown error")
-            print(f"[Error] {error_message}")
+        handler = self.MESSAGE_HANDLERS.get(message.get("type", ""))
+        if handler:
+            handler(self, message)
+
+    def show_chat(self, message):
+        """Print a chat message from the current channel."""
+        sender = message.get("sender", "")
+        content = message.get("content", "")
+        print(f"[{self.current_channel}] {sender}: {content}")
+
+    def show_private(self, message):
+        """Print a private message."""
+        sender = message.get("sender", "Unknown")
+        content = message.get("content", "")
+        print(f"[Private from {sender}]: {content}")
+
+    def show_server_message(self, message):
+        """Print a notification from the server."""
+        content = message.get("content", "")
+        print(f"[Server] {content}")
+
+    def show_channel_list(self, message):
+        """Print the list of available channels."""
+        channels = message.get("channels", [])
+        print("Available channels:")
+        for channel in channels:
+            print(f"- {channel}")
+
+    def show_user_list(self, message):
+        """Print the list of users in a channel."""
+        channel = message.get("channel", "")
+        users = message.get("users", [])
+        print(f"Users in channel {channel}:")
+        for user in users:
+            print(f"- {user}")
+
+    def show_error(self, message):
+        """Print an error reported by the server."""
+        error_message = message.get("content", "Unknown error")
+        print(f"[Error] {error_message}")
+
+    # {message type: handler}, used by process_message
+    MESSAGE_HANDLERS = {
+        "chat": show_chat,
+        "private": show_private,
+        "server_message": show_server_message,
+        "channel_list": show_channel_list,
+        "user_list": show_user_list,
+        "error": show_error,
+    }
 
     def disconnect(self):
         """Disconnect from the server."""
@@ -158,9 +168,7 @@ class ChatClient:
 
             try:
                 # Send a disconnect message to the server if possible
-                self.send_message({
-                    "type": "disconnect"
-                })
+                self.send_message(Disconnect())
 
                 # Shord delay to allow the message to be sent
                 time.sleep(0.5)
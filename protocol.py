@@ -0,0 +1,233 @@
+import socket
+import zlib
+from collections import deque
+
+import msgspec
+
+# Shared MessagePack codec used by both the client and the server.
+# Encoder/Decoder instances are reused because creating them per message
+# is much slower than the actual encoding work.
+_encoder = msgspec.msgpack.Encoder()
+_decoder = msgspec.msgpack.Decoder()
+
+DecodeError = msgspec.DecodeError
+
+# Every message on the wire is prefixed with a header of one flags byte and
+# the payload length as a 4-byte big-endian integer, so messages can be
+# split or coalesced by TCP freely.
+HEADER_SIZE = 5
+RECV_BUFFER_SIZE = 65536
+
+# Payloads larger than the threshold are zlib-compressed when that makes
+# them smaller. Level 1 is used because it is fast and still removes most
+# of the redundancy in chat text.
+FLAG_COMPRESSED = 0x01
+COMPRESSION_THRESHOLD = 512
+COMPRESSION_LEVEL = 1
+
+# Largest payload a peer may send, both on the wire and after decompression.
+# Without it a frame header alone could make the receive buffer grow to 4 GiB,
+# and a tiny compressed payload could expand into hundreds of megabytes.
+MAX_MESSAGE_SIZE = 4 * 1024 * 1024
+
+# sendmsg() is not available on Windows
+_HAS_SENDMSG = hasattr(socket.socket, "sendmsg")
+
+# Typed client requests. Each one is encoded as a map whose "type" field
+# holds its tag, so on the wire they look exactly like the plain dicts the
+# server expects, but a misspelled or missing field is caught when the
+# message is built instead of silently turning into an empty value.
+class SetNickname(msgspec.Struct, tag_field="type", tag="set_nickname"):
+    nickname: str
+
+class ChatMessage(msgspec.Struct, tag_field="type", tag="chat"):
+    content: str
+
+class PrivateMessage(msgspec.Struct, tag_field="type", tag="private"):
+    recipient: str
+    content: str
+
+class JoinChannel(msgspec.Struct, tag_field="type", tag="join_channel"):
+    channel: str
+
+class ListChannels(msgspec.Struct, tag_field="type", tag="list_channels"):
+    pass
+
+class ListUsers(msgspec.Struct, tag_field="type", tag="list_users"):
+    channel: str
+
+class Disconnect(msgspec.Struct, tag_field="type", tag="disconnect"):
+    pass
+
+def encode_message(message):
+    """Serialize a message dict or struct into bytes for the wire."""
+    return _encoder.encode(message)
+
+def decode_message(data):
+    """Deserialize bytes from the wire into a message dict."""
+    return _decoder.decode(data)
+
+def frame_message(message):
+    """Serialize a message into its header and payload buffers.
+
+    A frame is a tuple of buffers that are sent back to back. The parts are
+    kept separate so they can be handed to a gather write without first
+    copying them into one bytes object.
+    """
+    return _frame_payload(encode_message(message))
+
+def _frame_payload(payload):
+    """Compress a payload if worthwhile and build its header."""
+    flags = 0
+    if len(payload) > COMPRESSION_THRESHOLD:
+        compressed = zlib.compress(payload, COMPRESSION_LEVEL)
+        if len(compressed) < len(payload):
+            payload = compressed
+            flags |= FLAG_COMPRESSED
+
+    return (_header(flags, len(payload)), payload)
+
+def _header(flags, size):
+    """Build a frame header from its flags and payload size."""
+    return bytes((flags,)) + size.to_bytes(HEADER_SIZE - 1, 'big')
+
+# Server notifications only differ in their text. The map header and the
+# constant fields are encoded once here (0x82 is a MessagePack map with two
+# entries), so building a notification only encodes the content string.
+_SERVER_MESSAGE_PREFIX = (
+    b"\x82"
+    + _encoder.encode("type") + _encoder.encode("server_message")
+    + _encoder.encode("content")
+)
+
+def frame_server_message(content):
+    """Frame a {"type": "server_message", "content": content} message."""
+    encoded_content = _encoder.encode(content)
+    size = len(_SERVER_MESSAGE_PREFIX) + len(encoded_content)
+    if size > COMPRESSION_THRESHOLD:
+        return _frame_payload(_SERVER_MESSAGE_PREFIX + encoded_content)
+    return (_header(0, size), _SERVER_MESSAGE_PREFIX, encoded_content)
+
+def _decode_payload(flags, payload, max_size=MAX_MESSAGE_SIZE):
+    """Decompress a payload if its flags say so and decode it."""
+    if flags & FLAG_COMPRESSED:
+        decompressor = zlib.decompressobj()
+        try:
+            payload = decompressor.decompress(payload, max_size)
+        except zlib.error as e:
+            raise DecodeError(f"Invalid compressed payload: {e}")
+        if decompressor.unconsumed_tail:
+            raise DecodeError("Compressed payload is too large")
+        if not decompressor.eof:
+            raise DecodeError("Truncated compressed payload")
+    return _decoder.decode(payload)
+
+def send_buffers(sock, buffers):
+    """Send a list of buffers with a single system call and return bytes sent."""
+    if _HAS_SENDMSG:
+        return sock.sendmsg(buffers)
+    return sock.send(b"".join(buffers))
+
+def send_frame(sock, frame):
+    """Send a whole frame on a blocking socket."""
+    sent = send_buffers(sock, list(frame))
+    if sent < sum(len(buffer) for buffer in frame):
+        # Short writes are rare on blocking sockets, finish the simple way
+        sock.sendall(b"".join(frame)[sent:])
+
+class FrameBuffer:
+    def __init__(self, size=RECV_BUFFER_SIZE, max_size=MAX_MESSAGE_SIZE):
+        """Preallocated receive buffer that frames are decoded from in place."""
+        self.size = size
+        self.max_size = max_size # Largest payload accepted
+        self.buffer = bytearray(size)
+        self.offset = 0 # Bytes at the start of the buffer holding received data
+
+    def get_buffer(self):
+        """Return a writable view of the free space for recv_into()."""
+        if self.offset == len(self.buffer):
+            # A single frame is larger than the buffer, make room for it
+            grown = bytearray(2 * len(self.buffer))
+            grown[:self.offset] = self.buffer
+            self.buffer = grown
+        return memoryview(self.buffer)[self.offset:]
+
+    def buffer_updated(self, nbytes):
+        """Account for nbytes received into the view and decode complete frames.
+
+        Raises DecodeError for a frame larger than max_size. The stream can't
+        be read any further after that, so the connection should be closed.
+        """
+        self.offset += nbytes
+        with memoryview(self.buffer) as view:
+            messages, consumed = decode_frames(view[:self.offset], self.max_size)
+
+        if consumed:
+            # Move the start of an incomplete frame to the front of the buffer
+            remaining = self.offset - consumed
+            if len(self.buffer) > self.size and remaining <= self.size:
+                # Done with the large frame, give back the memory it needed
+                shrunk = bytearray(self.size)
+                shrunk[:remaining] = self.buffer[consumed:self.offset]
+                self.buffer = shrunk
+            else:
+                self.buffer[:remaining] = self.buffer[consumed:self.offset]
+            self.offset = remaining
+
+        return messages
+
+class MessageReader:
+    def __init__(self, sock):
+        """Read framed messages from a blocking socket."""
+        self.socket = sock
+        # The server adds short fields such as the sender's nickname to the
+        # messages it forwards, so allow frames somewhat over what it accepts
+        self.frames = FrameBuffer(max_size=2 * MAX_MESSAGE_SIZE)
+        self.pending = deque() # Decoded messages not returned yet
+
+    def read_message(self):
+        """Return the next message, or None when the connection is closed."""
+        while not self.pending:
+            nbytes = self.socket.recv_into(self.frames.get_buffer())
+            if not nbytes:
+                return None
+            try:
+                self.pending.extend(self.frames.buffer_updated(nbytes))
+            except DecodeError as e:
+                # Nothing after a bad frame header can be read
+                raise ConnectionError(f"Invalid frame: {e}")
+
+        message = self.pending.popleft()
+        if message is None:
+            raise DecodeError("Invalid message format")
+        return message
+
+def decode_frames(data, max_size=MAX_MESSAGE_SIZE):
+    """Decode every complete frame at the start of data.
+
+    Returns the decoded messages in order, with None in place of a frame
+    that could not be decoded, and the number of bytes they took up.
+    Payloads are decoded straight from a view of data, so a read holding
+    many small messages costs no per-message copies. Raises DecodeError
+    for a header announcing a payload larger than max_size.
+    """
+    messages = []
+    offset = 0
+
+    with memoryview(data) as view:
+        while len(view) - offset >= HEADER_SIZE:
+            start = offset + HEADER_SIZE
+            size = int.from_bytes(view[offset + 1:start], 'big')
+            if size > max_size:
+                raise DecodeError(f"Frame of {size} bytes is too large")
+            end = start + size
+            if len(view) < end:
+                break
+
+            try:
+                messages.append(_decode_payload(view[offset], view[start:end], max_size))
+            except DecodeError:
+                messages.append(None)
+            offset = end
+
+    return messages, offset
@@ -1,296 +1,305 @@
+import argparse
+import asyncio
+import logging
+import os
+import signal
 import socket
-import threading
-import json
 
-class ChatServer:
-    def __init__(self, host='0.0.0.0', port=9000):
-        """Initialize the chat server."""
-        self.host = host
-        self.port = port
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.clients = {} # {client_socket: {"nickname": nickname, "channel": channel}}
-        self.channels = {"general": set()} # Default channel
-        self.lock = threading.Lock() # For thread-safe operations on shared data
-
-    def start(self):
-        """Start the server and listen for connections."""
+try:
+    import uvloop
+except ImportError:
+    uvloop = None # Fall back to the default asyncio event loop
+
+from chat_core import ChatCore, Connection
+from protocol import MAX_MESSAGE_SIZE, DecodeError, FrameBuffer, frame_message
+
+logger = logging.getLogger("chat")
+
+class ClientProtocol(asyncio.BufferedProtocol):
+    def __init__(self, core):
+        """Handle the network side of a single client connection."""
+        self.core = core
+        self.transport = None
+        self.connection = None
+        self.writer_task = None # Kept referenced so the task isn't garbage collected
+        self.disconnected = False
+        # The event loop receives straight into this preallocated buffer
+        self.frames = FrameBuffer()
+        self.can_write = asyncio.Event() # Cleared while the transport buffer is full
+
+    def connection_made(self, transport):
+        """Start serving a newly accepted client."""
+        self.transport = transport
+        self.connection = Connection(transport.get_extra_info("peername"))
+        self.connection.abort = transport.abort
+        logger.info("New connection from %s", self.connection.address)
+
+        # asyncio and uvloop already set TCP_NODELAY on TCP transports, so
+        # small chat frames are not held back by Nagle's algorithm.
+        # SO_RCVBUF/SO_SNDBUF are left alone so Linux keeps autotuning them.
+        self.can_write.set()
+        self.writer_task = asyncio.get_running_loop().create_task(self.write_frames())
+
+    def get_buffer(self, sizehint):
+        """Return the free part of the receive buffer for the next read."""
+        return self.frames.get_buffer()
+
+    def buffer_updated(self, nbytes):
+        """Process every complete message that has been received."""
         try:
-            self.server_socket.bind((self.host, self.port))
-            self.server_socket.listen(5) # Max 5 connections in the queue
-            print(f"Server started on {self.host}:{self.port}")
-
-            while True:
-                client_socket, client_address = self.server_socket.accept()
-                print(f"New connection from {client_address}")
-
-                # Create and start a new thread for the client
-                client_thread = threading.Thread(
-                    target=self.handle_client,
-                    args=(client_socket, client_address)
-                )
-                client_thread.daemon = True
-                client_thread.start()
-            
-        except KeyboardInterrupt:
-            print("Server shutting down...")
+            # Decode every complete message first, then process the batch
+            for message in self.frames.buffer_updated(nbytes):
+                if self.disconnected:
+                    break  # An earlier message in the batch disconnected the client
+                self.core.handle_message(self.connection, message)
+        except DecodeError as e:
+            logger.warning("Invalid frame from %s: %s", self.connection.address, e)
+            self.disconnect()
+        except ConnectionError:
+            logger.info("Connection error with %s", self.connection.address)
+            self.disconnect()
         except Exception as e:
-            print(f"Error: {e}")
-        finally:
-            self.server_socket.close()
+            logger.exception("Unexpected error handling %s: %s", self.connection.address, e)
+            self.disconnect()
+
+    def connection_lost(self, exc):
+        """Clean up after the connection has been closed."""
+        if exc is not None:
+            logger.info("Connection error with %s", self.connection.address)
+        self.disconnect()
+        self.can_write.set() # Don't leave the writer task waiting forever
+
+    def pause_writing(self):
+        """Stop writing while the transport buffer is full."""
+        self.can_write.clear()
+
+    def resume_writing(self):
+        """Continue writing once the transport buffer has drained."""
+        self.can_write.set()
+
+    def disconnect(self):
+        """Remove the client from the chat, once."""
+        if self.disconnected:
+            return
+        self.disconnected = True
+
+        logger.debug("Cleaning up connection for %s", self.connection.address)
+        if not self.transport.is_closing():
+            self.transport.pause_reading()
+        self.core.handle_client_disconnect(self.connection)
+
+    async def write_frames(self):
+        """Write queued frames to the client until its connection is closed."""
+        send_queue = self.connection.send_queue
+        closing = False
 
-    def handle_client(self, client_socket, client_address):
-        """Handle a client connection."""
         try:
-            # Wait for the client to send their nickname
-            nickname_data = client_socket.recv(1024).decode('utf-8')
-            nickname_json = json.loads(nickname_data)
-            nickname = nickname_json.get("nickname", f"User-{client_address[0]}")
-
-            # Register the client
-            with self.lock:
-                self.clients[client_socket] = {
-                    "nickname": nickname,
-                    "channel": "general"
-                }
-                self.channels["general"].add(client_socket)
-
-            # Send welcome message
-            self.send_message_to_client(client_socket, {
-                "type": "server_message",
-                "content": f"Welcome to the chat, {nickname}!"
-            })
-            print(f"Client {nickname} connected from {client_address}")
-
-            # Notify others
-            self.broadcast_message({
-                "type": "server_message",
-                "content": f"{nickname} has joined the channel."
-            }, exclude=client_socket, channel="general")
-            print(f"Broadcasted join message to channel general")
-
-            # Main loop to receive messages
-            while True:
-                data = client_socket.recv(1024).decode('utf-8')
-                if not data:
+            while not closing:
+                frame = await send_queue.get()
+                if frame is None:
                     break
 
-                try:
-                    message = json.loads(data)
-                    self.process_message(client_socket, message)
-                except json.JSONDecodeError:
-                    self.send_message_to_client(client_socket, {
-                        "type": "server_message",
-                        "content": "Invalid message format."
-                    })
-                    print(f"Invalid message format from {nickname}: {data}")
-                
-        except ConnectionError:
-            print(f"Connection error with {client_address}")
-            pass  # Client disconnected
+                # Take everything else that is already queued as well so it
+                # all goes out in a single write
+                buffers = list(frame)
+                while not send_queue.empty():
+                    frame = send_queue.get_nowait()
+                    if frame is None:
+                        closing = True
+                        break
+                    buffers.extend(frame)
+                self.connection.queued_bytes -= sum([len(buffer) for buffer in buffers])
+
+                if self.transport.is_closing():
+                    break
+                self.transport.writelines(buffers)
+                await self.can_write.wait() # Wait here if the client reads slowly
         except Exception as e:
-            print(f"Unexpected error handling {client_address}: {e}")
+            logger.warning("Error sending message: %s", e)
         finally:
-            print(f"Cleaning up connection for {client_address}")
-            self.handle_client_disconnect(client_socket)
-
-    def process_message(self, client_socket, message):
-        """Process a message from a client."""
-        message_type = message.get("type", "")
-        sender = self.clients[client_socket]["nickname"]
-        current_channel = self.clients[client_socket]["channel"]
-
-        if message_type == "disconnect":
-            # Client is explicitly disconnecting
-            print(f"Client {sender} sent disconnect message")
-            raise ConnectionError("Client requested disconnect")
-
-        elif message_type == "chat":
-            content = message.get("content", "")
-            self.broadcast_message({
-                "type": "chat",
-                "sender": sender,
-                "content": content
-            }, channel=current_channel)
-        
-        elif message_type == "private":
-            recipient = message.get("recipient", "")
-            content = message.get("content", "")
-            self.send_private_message(client_socket, recipient, content)
-        
-        elif message_type == "join_channel":
-            new_channel = message.get("channel", "")
-            self.join_channel(client_socket, new_channel)
-
-        elif message_type == "list_channels":
-            self.list_channels(client_socket)
-
-        elif message_type == "list_users":
-            channel = message.get("channel", current_channel)
-            self.list_users(client_socket, channel)
-        
-        else:
-            self.send_message_to_client(client_socket, {
-                "type": "error",
-                "content": "Unknown message type."
-            })
-            print(f"Unknown message type from {sender}: {message_type}")
-
-    def send_message_to_client(self, client_socket, message):
-        """Send a message to a specific client."""
+            # Sends what the transport still buffers, then closes the socket
+            self.transport.close()
+            logger.debug("Closed connection for %s", self.connection.address)
+
+class BusProtocol(asyncio.BufferedProtocol):
+    def __init__(self, core):
+        """Receive the messages another worker process publishes."""
+        self.core = core
+        # Relayed messages carry whole client frames, which are only a short
+        # nickname or channel name larger than the payloads clients may send
+        self.frames = FrameBuffer(max_size=2 * MAX_MESSAGE_SIZE)
+        self.transport = None
+
+    def connection_made(self, transport):
+        """Keep the transport so a broken bus connection can be closed."""
+        self.transport = transport
+
+    def get_buffer(self, sizehint):
+        """Return the free part of the receive buffer for the next read."""
+        return self.frames.get_buffer()
+
+    def buffer_updated(self, nbytes):
+        """Deliver every complete message to the local clients."""
         try:
-            client_socket.send(json.dumps(message).encode('utf-8'))
-        except Exception as e:
-            print(f"Error sending message: {e}")
+            messages = self.frames.buffer_updated(nbytes)
+        except DecodeError as e:
+            logger.error("Invalid frame on the worker bus: %s", e)
+            self.transport.close()
+            return
+
+        for message in messages:
+            if message is None:
+                logger.warning("Invalid message on the worker bus")
+                continue
+            try:
+                self.core.handle_relay_message(message)
+            except Exception as e:
+                logger.exception("Error handling relayed message: %s", e)
+
+    def connection_lost(self, exc):
+        """Log when another worker process has gone away."""
+        logger.warning("Lost connection to a worker process")
+
+class WorkerBus:
+    def __init__(self):
+        """Fan messages out to the other worker processes."""
+        self.transports = [] # One Unix socket per other worker
+
+    def publish(self, message):
+        """Send a message to every other worker process."""
+        frame = frame_message(message) # Encoded once for every worker
+        for transport in self.transports:
+            if not transport.is_closing():
+                transport.writelines(frame)
 
-    def broadcast_message(self, message, exclude=None, channel=None):
-        """Broadcast a message to all clients in a channel."""
-        with self.lock:
-            if channel and channel in self.channels:
-                recipients = list(self.channels[channel])  # Make a copy to avoid modification issues
-            else:
-                recipients = list(self.clients.keys())
-            
-            print(f"Broadcasting to {len(recipients)} clients in channel {channel}")
-            
-            for client_socket in recipients:
-                if client_socket != exclude and client_socket in self.clients:
-                    try:
-                        self.send_message_to_client(client_socket, message)
-                    except Exception as e:
-                        print(f"Error broadcasting to client: {e}")
-
-    def send_private_message(self, sender_socket, recipient_name, content):
-        """Send a private message to a specific user."""
-        sender_name = self.clients[sender_socket]["nickname"]
-        recipient_socket = None
-
-        with self.lock:
-            for socket, info in self.clients.items():
-                if info["nickname"] == recipient_name:
-                    recipient_socket = socket
-                    break
-        
-        if recipient_socket:
-            # Send to recipient
-            self.send_message_to_client(recipient_socket, {
-                "type": "private",
-                "sender": sender_name,
-                "content": content
-            })
-            print(f"Private message sent from {sender_name} to {recipient_name}")
+class ChatServer:
+    def __init__(self, host='0.0.0.0', port=9000, workers=1):
+        """Initialize the chat server."""
+        self.host = host
+        self.port = port
+        # Clients, channels and message handling live in chat_core so that
+        # module can be compiled. All clients of a process are served by one
+        # asyncio event loop, so the shared state needs no lock.
+        self.core = ChatCore()
+        # With more than one worker, each worker process binds the port with
+        # SO_REUSEPORT and the kernel spreads new connections across them
+        self.workers = workers
+        self.bus_sockets = [] # This worker's Unix sockets to the other workers
 
+    def start(self):
+        """Start the server, in several worker processes if requested."""
+        if self.workers > 1 and not (hasattr(os, "fork") and hasattr(socket, "SO_REUSEPORT")):
+            logger.warning("Worker processes are not supported here, running a single process")
+            self.workers = 1
+
+        if self.workers > 1:
+            self.start_workers()
         else:
-            self.send_message_to_client(sender_socket, {
-                "type": "server_message",
-                "content": f"User {recipient_name} not found."
-            })
-            print(f"Private message failed: User {recipient_name} not found")
-    
-    def join_channel(self, client_socket, channel):
-        """Move a client to a different channel."""
-        client_info = self.clients[client_socket]
-        old_channel = client_info["channel"]
-
-        with self.lock:
-            # Create the channel if it doesn't exist
-            if channel not in self.channels:
-                self.channels[channel] = set()
-                print(f"Channel {channel} created")
-
-            # Remove from old channel
-            if old_channel in self.channels:
-                self.channels[old_channel].discard(client_socket)
-
-            # Add to new channel
-            self.channels[channel].add(client_socket)
-            client_info["channel"] = channel
-
-        # Notify the client
-        self.send_message_to_client(client_socket, {
-            "type": "server_message",
-            "content": f"You have joined the channel: {channel}"
-        })
-        print(f"{client_info['nickname']} joined channel {channel}")
-
-        # Notify others in the old channel
-        self.broadcast_message({
-            "type": "server_message",
-            "content": f"{client_info['nickname']} has joined the channel"
-        }, exclude=client_socket, channel=channel)
-        print(f"Broadcasted channel join message to {channel}")
-
-    def list_channels(self, client_socket):
-        """Send a list of available channels to the client."""
-        with self.lock:
-            channels = list(self.channels.keys())
-        
-        self.send_message_to_client(client_socket, {
-            "type": "channel_list",
-            "channels": channels
-        })
-        print(f"Sent channel list to {self.clients[client_socket]['nickname']}")
-
-    def list_users(self, client_socket, channel):
-        """Send a list of users in a channel to the client."""
-        user_list = []
-
-        with self.lock:
-            if channel in self.channels:
-                for client in self.channels[channel]:
-                    if client in self.clients:
-                        user_list.append(self.clients[client]["nickname"])
-        
-        self.send_message_to_client(client_socket, {
-            "type": "user_list",
-            "channel": channel,
-            "users": user_list
-        })
-        print(f"Sent user list for channel {channel} to {self.clients[client_socket]['nickname']}")
-
-    def handle_client_disconnect(self, client_socket):
-        """Clean up when a client disconnects."""
-        try:
-            with self.lock:
-                if client_socket in self.clients:
-                    # Get client info before removal
-                    nickname = self.clients[client_socket]["nickname"]
-                    channel = self.clients[client_socket]["channel"]
-
-                    print(f"Disconnecting client {nickname} from channel {channel}")
-
-                    # Notify all users in the channel about the disconnection
-                    for socket in list(self.channels.get(channel, set())):
-                        if socket != client_socket and socket in self.clients:
-                            try:
-                                self.send_message_to_client(socket, {
-                                    "type": "server_message",
-                                    "content": f"{nickname} has left the chat."
-                                })
-                            except Exception as e:
-                                print(f"Error notifying client about disconnect: {e}")
-                    
-                    # Remove from all channels (in case client is in multiple)
-                    for channel_name, clients in self.channels.items():
-                        if client_socket in clients:
-                            clients.discard(client_socket)
-                            print(f"Removed {nickname} from channel {channel_name}")
-
-                    # Remove client from clients dict
-                    del self.clients[client_socket]
-                    print(f"Removed {nickname} from clients list")
-                else:
-                    print(f"Client socket not found in clients dict during disconnect")
-        except Exception as e:
-            print(f"Error in disconnect handler: {e}")
+            self.run()
+
+    def start_workers(self):
+        """Fork the worker processes and wait for them to exit."""
+        # Connect every pair of workers, so a broadcast takes one hop
+        peers = {worker: [] for worker in range(self.workers)}
+        for worker in range(self.workers):
+            for other in range(worker + 1, self.workers):
+                worker_end, other_end = socket.socketpair()
+                peers[worker].append(worker_end)
+                peers[other].append(other_end)
+
+        pids = []
+        for worker in range(self.workers):
+            pid = os.fork()
+            if pid == 0:
+                # Keep only this worker's ends of the bus
+                for other, sockets in peers.items():
+                    if other != worker:
+                        for sock in sockets:
+                            sock.close()
+                self.bus_sockets = peers[worker]
+                try:
+                    self.run()
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+
+        for sockets in peers.values():
+            for sock in sockets:
+                sock.close()
+        logger.info("Started %d worker processes", len(pids))
 
-        # Close the socket outside the lock
+        # A plain kill or service stop must not leave the workers running as
+        # orphans that keep serving the port
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop_workers(pids, signum))
+
+        try:
+            self.wait_workers(pids)
+        except KeyboardInterrupt:
+            # Stop the workers too, in case the interrupt didn't reach them
+            self.stop_workers(pids, signal.SIGINT)
+            self.wait_workers(pids)
+        logger.info("Server shutting down...")
+
+    def stop_workers(self, pids, signum):
+        """Send a signal to every worker process that is still running."""
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass # Already exited
+
+    def wait_workers(self, pids):
+        """Wait for the worker processes to exit, removing them from pids."""
+        while pids:
+            os.waitpid(pids[0], 0)
+            pids.pop(0)
+
+    def run(self):
+        """Run the event loop of this process."""
         try:
-            client_socket.close()
-            print(f"Closed socket for client {nickname}")
+            if uvloop is not None:
+                # Same asyncio API, but the loop and transports run on libuv
+                uvloop.run(self.serve())
+            else:
+                asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            logger.info("Server shutting down...")
         except Exception as e:
-            print(f"Error closing client socket: {e}")
+            logger.error("Error: %s", e)
+
+    async def serve(self):
+        """Accept connections until the server is stopped."""
+        if self.bus_sockets:
+            bus = WorkerBus()
+            for sock in self.bus_sockets:
+                transport, _ = await asyncio.get_running_loop().create_unix_connection(
+                    lambda: BusProtocol(self.core), sock=sock
+                )
+                bus.transports.append(transport)
+            # Broadcasts also reach the clients of the other workers. This is
+            # set up before accepting, so no client misses the relay.
+            self.core.relay = bus.publish
+
+        server = await asyncio.get_running_loop().create_server(
+            lambda: ClientProtocol(self.core), self.host, self.port,
+            reuse_address=True,
+            reuse_port=self.workers > 1, # Every worker binds the same port
+            backlog=socket.SOMAXCONN # Let the kernel cap the accept queue
+        )
+        logger.info("Server started on %s:%s", self.host, self.port)
+        logger.debug("Using event loop %s", type(asyncio.get_running_loop()).__name__)
+
+        async with server:
+            await server.serve_forever()
 
 if __name__ == "__main__":
-    server = ChatServer()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(process)d] %(levelname)s %(message)s")
+    parser = argparse.ArgumentParser(description="Run the chat server.")
+    parser.add_argument(
+        "--workers", type=int, default=1,
+        help="number of worker processes, e.g. the number of CPU cores (default: 1)"
+    )
+    args = parser.parse_args()
+
+    server = ChatServer(workers=args.workers)
     server.start()
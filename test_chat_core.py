@@ -0,0 +1,176 @@
+import unittest
+
+from chat_core import MAX_NAME_LENGTH, MAX_QUEUED_BYTES, ChatCore, Connection
+from protocol import decode_frames, frame_message, frame_server_message
+
+def received(connection):
+    """Return the messages queued for a connection, None for the close sentinel."""
+    messages = []
+    while not connection.send_queue.empty():
+        frame = connection.send_queue.get_nowait()
+        if frame is None:
+            messages.append(None)
+        else:
+            messages.extend(decode_frames(b"".join(frame))[0])
+    return messages
+
+def contents(connection):
+    """Return the content of every message queued for a connection."""
+    return [message.get("content") for message in received(connection) if message is not None]
+
+class ChatCoreTest(unittest.TestCase):
+    def setUp(self):
+        self.core = ChatCore()
+        self.port = 1000
+
+    def connect(self, nickname):
+        """Register a new client and discard the messages it receives on joining."""
+        self.port += 1
+        connection = Connection(("127.0.0.1", self.port))
+        self.core.handle_message(connection, {"type": "set_nickname", "nickname": nickname})
+        received(connection)
+        return connection
+
+class RegisterClientTest(ChatCoreTest):
+    def test_valid_nickname(self):
+        alice = self.connect("alice")
+        self.assertEqual(self.core.clients[alice]["nickname"], "alice")
+
+    def test_too_long_nickname_is_rejected(self):
+        connection = Connection(("127.0.0.1", 1))
+        with self.assertRaises(ConnectionError):
+            self.core.register_client(connection, {"nickname": "x" * (MAX_NAME_LENGTH + 1)})
+        self.assertNotIn(connection, self.core.clients)
+        self.assertIn("Invalid nickname", contents(connection)[0])
+
+    def test_non_string_nickname_is_rejected(self):
+        connection = Connection(("127.0.0.1", 1))
+        with self.assertRaises(ConnectionError):
+            self.core.register_client(connection, {"nickname": b"alice"})
+        self.assertNotIn(connection, self.core.clients)
+
+    def test_too_long_channel_name_is_rejected(self):
+        alice = self.connect("alice")
+        self.core.handle_message(alice, {"type": "join_channel", "channel": "x" * (MAX_NAME_LENGTH + 1)})
+        self.assertIn("Invalid channel name", contents(alice)[0])
+        self.assertEqual(self.core.clients[alice]["channel"], "general")
+        self.assertEqual(list(self.core.channels), ["general"])
+
+class SharedNicknameTest(ChatCoreTest):
+    def test_first_registered_client_wins(self):
+        alice = self.connect("alice")
+        first_bob = self.connect("bob")
+        second_bob = self.connect("bob")
+        received(first_bob) # The second bob's join notice
+
+        self.core.handle_message(alice, {"type": "private", "recipient": "bob", "content": "hi"})
+        self.assertEqual(contents(first_bob), ["hi"])
+        self.assertEqual(contents(second_bob), [])
+
+    def test_nickname_passes_to_next_client(self):
+        alice = self.connect("alice")
+        first_bob = self.connect("bob")
+        second_bob = self.connect("bob")
+        self.core.handle_client_disconnect(first_bob)
+        received(alice)
+
+        self.core.handle_message(alice, {"type": "private", "recipient": "bob", "content": "hi"})
+        self.assertEqual(contents(second_bob), ["bob has left the chat.", "hi"])
+        self.assertEqual(contents(alice), [])
+
+        self.core.handle_client_disconnect(second_bob)
+        self.assertNotIn("bob", self.core.nicknames)
+
+class RelayTest(ChatCoreTest):
+    def setUp(self):
+        super().setUp()
+        self.published = []
+        self.core.relay = self.published.append
+
+    def test_broadcast_is_published(self):
+        alice = self.connect("alice")
+        bob = self.connect("bob")
+        self.published.clear()
+
+        self.core.handle_message(alice, {"type": "chat", "content": "hi"})
+        self.assertEqual(contents(bob), ["hi"])
+        self.assertEqual(len(self.published), 1)
+        relayed = self.published[0]
+        self.assertEqual(relayed["type"], "broadcast")
+        self.assertEqual(relayed["channel"], "general")
+        self.assertEqual(decode_frames(relayed["frame"])[0],
+                         [{"type": "chat", "sender": "alice", "content": "hi"}])
+
+    def test_private_message_to_unknown_nickname_is_published(self):
+        alice = self.connect("alice")
+        self.published.clear()
+
+        self.core.handle_message(alice, {"type": "private", "recipient": "bob", "content": "hi"})
+        # Bob may be on another worker, so there is no "not found" reply
+        self.assertEqual(contents(alice), [])
+        self.assertEqual(len(self.published), 1)
+        relayed = self.published[0]
+        self.assertEqual(relayed["type"], "private")
+        self.assertEqual(relayed["recipient"], "bob")
+        self.assertEqual(decode_frames(relayed["frame"])[0],
+                         [{"type": "private", "sender": "alice", "content": "hi"}])
+
+    def test_private_message_to_local_nickname_is_not_published(self):
+        alice = self.connect("alice")
+        bob = self.connect("bob")
+        received(alice)
+        self.published.clear()
+
+        self.core.handle_message(alice, {"type": "private", "recipient": "bob", "content": "hi"})
+        self.assertEqual(contents(bob), ["hi"])
+        self.assertEqual(self.published, [])
+
+    def test_relayed_broadcast_reaches_every_local_member(self):
+        alice = self.connect("alice")
+        bob = self.connect("bob")
+        received(alice)
+        self.published.clear()
+        frame = b"".join(frame_server_message("carol has joined the channel."))
+
+        self.core.handle_relay_message({"type": "broadcast", "channel": "general", "frame": frame})
+        self.assertEqual(contents(alice), ["carol has joined the channel."])
+        self.assertEqual(contents(bob), ["carol has joined the channel."])
+        # Delivering a relayed message doesn't publish it again
+        self.assertEqual(self.published, [])
+
+    def test_relayed_broadcast_to_unknown_channel_is_dropped(self):
+        alice = self.connect("alice")
+        frame = b"".join(frame_message({"type": "chat", "sender": "carol", "content": "hi"}))
+
+        self.core.handle_relay_message({"type": "broadcast", "channel": "room", "frame": frame})
+        self.assertEqual(contents(alice), [])
+
+    def test_relayed_private_message(self):
+        alice = self.connect("alice")
+        frame = b"".join(frame_message({"type": "private", "sender": "carol", "content": "hi"}))
+
+        self.core.handle_relay_message({"type": "private", "recipient": "alice", "frame": frame})
+        self.core.handle_relay_message({"type": "private", "recipient": "bob", "frame": frame})
+        self.assertEqual(contents(alice), ["hi"])
+
+class SendQueueLimitTest(ChatCoreTest):
+    def test_client_falling_behind_is_aborted_once(self):
+        connection = Connection(("127.0.0.1", 1))
+        aborts = []
+        connection.abort = lambda: aborts.append(connection)
+        frame = (b"x" * (MAX_QUEUED_BYTES // 4),)
+
+        for _ in range(4):
+            self.core.send_frame_to_client(connection, frame)
+        self.assertEqual(aborts, [])
+        self.assertEqual(connection.queued_bytes, MAX_QUEUED_BYTES)
+
+        for _ in range(3):
+            self.core.send_frame_to_client(connection, frame)
+        self.assertEqual(aborts, [connection])
+        # Neither the frame over the limit nor later ones are queued or counted
+        self.assertEqual(connection.send_queue.qsize(), 4)
+        self.assertEqual(connection.queued_bytes, MAX_QUEUED_BYTES)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+import os
+import unittest
+import zlib
+
+from protocol import (
+    COMPRESSION_THRESHOLD, FLAG_COMPRESSED, HEADER_SIZE, MAX_MESSAGE_SIZE,
+    DecodeError, FrameBuffer, _frame_payload, _header, decode_frames,
+    encode_message, frame_message, frame_server_message,
+)
+
+def frame_bytes(message):
+    """Return a message framed as one bytes object."""
+    return b"".join(frame_message(message))
+
+def feed(frames, data, chunk_size):
+    """Receive data into a FrameBuffer in reads of at most chunk_size bytes."""
+    messages = []
+    while data:
+        view = frames.get_buffer()
+        nbytes = min(len(view), chunk_size, len(data))
+        view[:nbytes] = data[:nbytes]
+        data = data[nbytes:]
+        messages.extend(frames.buffer_updated(nbytes))
+    return messages
+
+class FramePayloadTest(unittest.TestCase):
+    def test_small_payload_is_not_compressed(self):
+        header, payload = _frame_payload(b"x" * COMPRESSION_THRESHOLD)
+        self.assertEqual(header, _header(0, COMPRESSION_THRESHOLD))
+        self.assertEqual(payload, b"x" * COMPRESSION_THRESHOLD)
+
+    def test_large_payload_is_compressed(self):
+        header, payload = _frame_payload(b"x" * 10000)
+        self.assertEqual(header[0], FLAG_COMPRESSED)
+        self.assertEqual(int.from_bytes(header[1:], 'big'), len(payload))
+        self.assertEqual(zlib.decompress(payload), b"x" * 10000)
+
+    def test_incompressible_payload_is_sent_as_is(self):
+        data = os.urandom(10000)
+        header, payload = _frame_payload(data)
+        self.assertEqual(header, _header(0, len(data)))
+        self.assertEqual(payload, data)
+
+class FrameServerMessageTest(unittest.TestCase):
+    def assert_same_frame(self, content):
+        message = {"type": "server_message", "content": content}
+        self.assertEqual(b"".join(frame_server_message(content)), frame_bytes(message))
+
+    def test_matches_frame_message(self):
+        self.assert_same_frame("Welcome to the chat, alice!")
+        self.assert_same_frame("")
+
+    def test_matches_frame_message_when_compressed(self):
+        self.assert_same_frame("alice has joined the channel. " * 100)
+
+class DecodeFramesTest(unittest.TestCase):
+    def test_several_frames(self):
+        first = {"type": "chat", "content": "hello"}
+        second = {"type": "list_channels"}
+        data = frame_bytes(first) + frame_bytes(second)
+        self.assertEqual(decode_frames(data), ([first, second], len(data)))
+
+    def test_incomplete_frame_is_left(self):
+        data = frame_bytes({"type": "chat", "content": "hello"})
+        self.assertEqual(decode_frames(data[:-1]), ([], 0))
+        self.assertEqual(decode_frames(data[:HEADER_SIZE - 1]), ([], 0))
+
+    def test_compressed_frame(self):
+        message = {"type": "chat", "content": "a" * 5000}
+        data = frame_bytes(message)
+        self.assertEqual(data[0], FLAG_COMPRESSED)
+        self.assertEqual(decode_frames(data), ([message], len(data)))
+
+    def test_corrupt_payload(self):
+        message = {"type": "chat", "content": "hello"}
+        corrupt = _header(0, 3) + b"\xc1\xc1\xc1"
+        data = corrupt + frame_bytes(message)
+        self.assertEqual(decode_frames(data), ([None, message], len(data)))
+
+    def test_corrupt_compressed_payload(self):
+        data = _header(FLAG_COMPRESSED, 4) + b"\x00\x01\x02\x03"
+        self.assertEqual(decode_frames(data), ([None], len(data)))
+
+    def test_decompression_bomb(self):
+        payload = zlib.compress(encode_message({"content": "x" * (MAX_MESSAGE_SIZE + 1)}))
+        data = _header(FLAG_COMPRESSED, len(payload)) + payload
+        self.assertEqual(decode_frames(data), ([None], len(data)))
+
+    def test_oversized_frame_header(self):
+        with self.assertRaises(DecodeError):
+            decode_frames(_header(0, MAX_MESSAGE_SIZE + 1))
+
+class FrameBufferTest(unittest.TestCase):
+    def test_frames_split_across_reads(self):
+        messages = [{"type": "chat", "content": f"message {i}"} for i in range(3)]
+        data = b"".join(frame_bytes(message) for message in messages)
+        self.assertEqual(feed(FrameBuffer(), data, 1), messages)
+        self.assertEqual(feed(FrameBuffer(), data, 7), messages)
+
+    def test_several_frames_in_one_read(self):
+        messages = [{"type": "chat", "content": f"message {i}"} for i in range(100)]
+        data = b"".join(frame_bytes(message) for message in messages)
+        frames = FrameBuffer()
+        self.assertEqual(feed(frames, data, len(data)), messages)
+        self.assertEqual(frames.offset, 0)
+
+    def test_frame_larger_than_buffer(self):
+        large = {"type": "chat", "content": os.urandom(1000)}
+        small = {"type": "chat", "content": "hello"}
+        frames = FrameBuffer(size=64)
+        self.assertEqual(feed(frames, frame_bytes(large) + frame_bytes(small), 50), [large, small])
+        # The buffer goes back to its initial size once the frame is consumed
+        self.assertEqual(len(frames.buffer), 64)
+
+    def test_oversized_frame_header(self):
+        frames = FrameBuffer(max_size=1000)
+        with self.assertRaises(DecodeError):
+            feed(frames, _header(0, 1001), HEADER_SIZE)
+
+if __name__ == "__main__":
+    unittest.main()